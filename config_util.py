@@ -2,7 +2,7 @@ from typing import Literal, Optional
 
 import yaml
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 import torch
 
 from lora import TRAINING_METHODS
@@ -36,9 +36,19 @@ class TrainConfig(BaseModel):
     optimizer: str = "adamw"
     optimizer_args: str = ""
     lr_scheduler: str = "constant"
+    grad_accum_steps: int = Field(1, ge=1)
 
     max_denoising_steps: int = 50
 
+    # 0 で無効。SD v1/v2 のみ
+    # 途中から再開するときは scheduler をまっさらなコピーで始めるので、厳密に同じ結果になるのは
+    # DDIM のような状態を持たない scheduler だけ (lms だと過去の derivatives が失われる)
+    trajectory_cache_size: int = 0
+    # キャッシュした軌跡は、始めたときから optimizer step がこれより進んだら使わずに捨てる
+    # (古い LoRA で作った latents を使い続けないように。キャッシュの大きさとは別の上限)
+    trajectory_max_age: int = Field(20, ge=1)
+    trajectory_noise_pool: int = 8
+
 
 class SaveConfig(BaseModel):
     name: str = "untitled"
@@ -49,6 +59,7 @@ class SaveConfig(BaseModel):
 
 class LoggingConfig(BaseModel):
     use_wandb: bool = False
+    per_steps: int = Field(10, ge=1)
 
     verbose: bool = False
 
@@ -56,6 +67,10 @@ class LoggingConfig(BaseModel):
 class OtherConfig(BaseModel):
     use_xformers: bool = False
 
+    use_torch_compile: bool = False
+    use_cuda_graph: bool = False  # use_torch_compile のときは無視される
+    use_aot_compile: bool = False  # SD v1/v2 のみ。compile した package は ./.aoti_cache に置いて使い回す
+
 
 class RootConfig(BaseModel):
     prompts_file: str
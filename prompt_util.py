@@ -1,4 +1,4 @@
-from typing import Literal, Optional, Union
+from typing import Callable, Literal, Optional, Union
 
 import yaml
 from pathlib import Path
@@ -79,12 +79,12 @@ class PromptEmbedsPair:
     batch_size: int
     dynamic_crops: bool
 
-    loss_fn: torch.nn.Module
+    loss_fn: Callable[[torch.FloatTensor, torch.FloatTensor], torch.FloatTensor]
     action: ACTION_TYPES
 
     def __init__(
         self,
-        loss_fn: torch.nn.Module,
+        loss_fn: Callable[[torch.FloatTensor, torch.FloatTensor], torch.FloatTensor],
         target: PROMPT_EMBEDDING,
         positive: PROMPT_EMBEDDING,
         unconditional: PROMPT_EMBEDDING,
@@ -113,12 +113,16 @@ class PromptEmbedsPair:
     ) -> torch.FloatTensor:
         """Target latents are going not to have the positive concept."""
 
-        return self.loss_fn(
-            target_latents,
-            neutral_latents
-            - self.guidance_scale * (positive_latents - unconditional_latents),
+        # neutral - guidance_scale * (positive - unconditional)
+        # 学習しない側の latents から作る目標なので、勾配は流れない。一時テンソルを一つで済ませるため in-place で計算する
+        guided_latents = (
+            positive_latents.sub(unconditional_latents)
+            .mul_(-self.guidance_scale)
+            .add_(neutral_latents)
         )
 
+        return self.loss_fn(target_latents, guided_latents)
+
     def _enhance(
         self,
         target_latents: torch.FloatTensor,  # "van gogh"
@@ -128,12 +132,15 @@ class PromptEmbedsPair:
     ):
         """Target latents are going to have the positive concept."""
 
-        return self.loss_fn(
-            target_latents,
-            neutral_latents
-            + self.guidance_scale * (positive_latents - unconditional_latents),
+        # neutral + guidance_scale * (positive - unconditional)
+        guided_latents = (
+            positive_latents.sub(unconditional_latents)
+            .mul_(self.guidance_scale)
+            .add_(neutral_latents)
         )
 
+        return self.loss_fn(target_latents, guided_latents)
+
     def loss(
         self,
         **kwargs,
@@ -5,11 +5,15 @@
 from typing import List, Optional
 import argparse
 import ast
+import copy
+import math
 from pathlib import Path
 import gc
 
 import torch
+import torch.nn.functional as F
 from tqdm import tqdm
+from diffusers.models.attention_processor import AttnProcessor2_0
 
 
 from lora import LoRANetwork, DEFAULT_TARGET_REPLACE, UNET_TARGET_REPLACE_MODULE_CONV
@@ -41,6 +45,11 @@ def train(
     }
     save_path = Path(config.save.path)
 
+    # fp32 の matmul/conv でも TF32 の Tensor Core を使う。入力の形はほぼ固定なので conv のアルゴリズムも最初に選ばせる
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cudnn.benchmark = True
+
     modules = DEFAULT_TARGET_REPLACE
     if config.network.type == "c3lier":
         modules += UNET_TARGET_REPLACE_MODULE_CONV
@@ -64,44 +73,7 @@ def train(
     text_encoder.to(DEVICE_CUDA, dtype=weight_dtype)
     text_encoder.eval()
 
-    unet.to(DEVICE_CUDA, dtype=weight_dtype)
-    unet.enable_xformers_memory_efficient_attention()
-    unet.requires_grad_(False)
-    unet.eval()
-
-    network = LoRANetwork(
-        unet,
-        rank=config.network.rank,
-        multiplier=1.0,
-        alpha=config.network.alpha,
-        train_method=config.network.training_method,
-    ).to(DEVICE_CUDA, dtype=weight_dtype)
-
-    optimizer_module = train_util.get_optimizer(config.train.optimizer)
-    #optimizer_args
-    optimizer_kwargs = {}
-    if config.train.optimizer_args is not None and len(config.train.optimizer_args) > 0:
-        for arg in config.train.optimizer_args.split(" "):
-            key, value = arg.split("=")
-            value = ast.literal_eval(value)
-            optimizer_kwargs[key] = value
-            
-    optimizer = optimizer_module(network.prepare_optimizer_params(), lr=config.train.lr, **optimizer_kwargs)
-    lr_scheduler = train_util.get_lr_scheduler(
-        config.train.lr_scheduler,
-        optimizer,
-        max_iterations=config.train.iterations,
-        lr_min=config.train.lr / 100,
-    )
-    criteria = torch.nn.MSELoss()
-
-    print("Prompts")
-    for settings in prompts:
-        print(settings)
-
-    # debug
-    debug_util.check_requires_grad(network)
-    debug_util.check_training_mode(network)
+    criteria = F.mse_loss
 
     cache = PromptEmbedsCache()
     prompt_pairs: list[PromptEmbedsPair] = []
@@ -131,24 +103,159 @@ def train(
                 )
             )
 
+    # unet を載せる前に text encoder を GPU から降ろしておく
+    text_encoder.to("cpu")
     del tokenizer
     del text_encoder
 
     flush()
 
+    # set_timesteps は毎回呼ぶとテーブルを作り直すので、ループの外で一度だけ
+    noise_scheduler.set_timesteps(
+        config.train.max_denoising_steps, device=DEVICE_CUDA
+    )
+    full_noise_scheduler = copy.deepcopy(noise_scheduler)
+    full_noise_scheduler.set_timesteps(1000)
+    # timesteps_to から 1000 step 中のタイムステップを引くための表
+    # (scheduler の timesteps と同じ CPU に置いておく。GPU に置くと scheduler 内の比較でデバイスが合わない)
+    timestep_lut = full_noise_scheduler.timesteps[
+        torch.arange(config.train.max_denoising_steps)
+        * 1000
+        // config.train.max_denoising_steps
+    ]
+
+    unet.to(DEVICE_CUDA, dtype=weight_dtype)
+    # conv は NHWC の方が cuDNN の速いカーネルが使える
+    unet.to(memory_format=torch.channels_last)
+    if config.other.use_xformers:
+        unet.enable_xformers_memory_efficient_attention()
+    else:
+        # PyTorch 2 の scaled_dot_product_attention (FlashAttention など) を使う
+        unet.set_attn_processor(AttnProcessor2_0())
+    unet.requires_grad_(False)
+    unet.eval()
+
+    # LoRA を無効にした推論 (positive, neutral, unconditional) 用に、LoRA を付ける前の unet を AOT compile しておく
+    # 形が固定のときしか使えないので、最初の prompt の解像度と batch_size で export する
+    aot_unet = None
+    if config.other.use_aot_compile:
+        example_pair = prompt_pairs[0]
+        example_embeddings = train_util.concat_embeddings_multi(
+            example_pair.unconditional,
+            [example_pair.positive, example_pair.neutral, example_pair.unconditional],
+            example_pair.batch_size,
+        )
+        aot_unet = train_util.aot_compile_unet(
+            unet,
+            # predict_noise の中の repeat と cat で作られる入力と同じ、普通の (NCHW) contiguous なレイアウトにする
+            torch.randn(
+                (
+                    example_embeddings.shape[0],
+                    train_util.UNET_IN_CHANNELS,
+                    example_pair.resolution // train_util.VAE_SCALE_FACTOR,
+                    example_pair.resolution // train_util.VAE_SCALE_FACTOR,
+                ),
+                device=DEVICE_CUDA,
+                dtype=weight_dtype,
+            ),
+            timestep_lut[0],
+            example_embeddings,
+            config.pretrained_model.name_or_path,
+        )
+
+    network = LoRANetwork(
+        unet,
+        rank=config.network.rank,
+        multiplier=1.0,
+        alpha=config.network.alpha,
+        train_method=config.network.training_method,
+    ).to(
+        DEVICE_CUDA,
+        dtype=torch.float32,
+        memory_format=torch.channels_last,
+    )
+
+    # 凍結した unet は weight_dtype のまま、学習する LoRA の重みは fp32 で持っておいて autocast で計算する
+    # (LoRA の重みまで低精度にすると小さな更新が丸められて不安定になる)
+    use_autocast = weight_dtype != torch.float32
+
+    if config.other.use_torch_compile:
+        # 最初の数 iteration は compile 待ちで遅くなる
+        unet = train_util.compile_unet(unet)
+
+    # AOT compile できなかったときは (compile された) unet をそのまま使う
+    frozen_unet = unet
+    if aot_unet is not None:
+        # 形が合わずに fallback するときも compile された unet を使う
+        aot_unet.unet = unet
+        frozen_unet = aot_unet
+
+    # diffusion() は LoRA を有効にした状態でしか呼ばないので、そこだけ CUDA Graph で回す
+    diffusion_unet = unet
+    if config.other.use_cuda_graph and not config.other.use_torch_compile:
+        diffusion_unet = train_util.CUDAGraphUNet(unet)
+
+    optimizer_module = train_util.get_optimizer(config.train.optimizer)
+    #optimizer_args
+    optimizer_kwargs = {}
+    if config.train.optimizer_args is not None and len(config.train.optimizer_args) > 0:
+        for arg in config.train.optimizer_args.split(" "):
+            key, value = arg.split("=")
+            value = ast.literal_eval(value)
+            optimizer_kwargs[key] = value
+
+    if (
+        optimizer_module in (torch.optim.Adam, torch.optim.AdamW)
+        and "foreach" not in optimizer_kwargs
+    ):
+        # LoRA は小さいパラメータが大量にあるので、パラメータごとではなくまとめて一つのカーネルで更新する
+        # (fused と foreach は同時に指定できないので、foreach が指定されていたらそちらに任せる)
+        optimizer_kwargs.setdefault("fused", True)
+
+    optimizer = optimizer_module(network.prepare_optimizer_params(), lr=config.train.lr, **optimizer_kwargs)
+    lr_scheduler = train_util.get_lr_scheduler(
+        config.train.lr_scheduler,
+        optimizer,
+        # lr_scheduler は optimizer を更新したときだけ進める
+        max_iterations=math.ceil(
+            config.train.iterations / config.train.grad_accum_steps
+        ),
+        lr_min=config.train.lr / 100,
+    )
+
+    print("Prompts")
+    for settings in prompts:
+        print(settings)
+
+    # debug
+    if config.logging.verbose:
+        debug_util.check_requires_grad(network)
+        debug_util.check_training_mode(network)
+
+    # diffusion の途中結果のキャッシュ。LoRA の学習が進む前の結果も使い回すことになるので、デフォルトでは無効
+    # また、途中から再開するときの scheduler はまっさらなコピーなので、厳密に一致するのは DDIM など状態を持たないものだけ
+    # (lms では途中までの derivatives の履歴が失われる)
+    trajectory_cache = None
+    if config.train.trajectory_cache_size > 0:
+        trajectory_cache = train_util.TrajectoryCache(
+            config.train.trajectory_cache_size,
+            config.train.trajectory_max_age,
+        )
+
     pbar = tqdm(range(config.train.iterations))
 
     for i in pbar:
-        with torch.no_grad():
-            noise_scheduler.set_timesteps(
-                config.train.max_denoising_steps, device=DEVICE_CUDA
-            )
-
-            optimizer.zero_grad()
+        # 勾配の要らない推論は inference_mode で autograd の記録を完全に切る
+        # (text embeddings は LoRA の backward で保存されるので、そちらは no_grad のまま作っている)
+        with torch.inference_mode(), torch.autocast(
+            "cuda", dtype=weight_dtype, enabled=use_autocast
+        ):
+            # step() で内部状態が変わる scheduler もあるので、毎回設定済みのものからコピーする
+            diffusion_scheduler = copy.deepcopy(noise_scheduler)
+            full_scheduler = copy.deepcopy(full_noise_scheduler)
 
-            prompt_pair: PromptEmbedsPair = prompt_pairs[
-                torch.randint(0, len(prompt_pairs), (1,)).item()
-            ]
+            prompt_index = torch.randint(0, len(prompt_pairs), (1,)).item()
+            prompt_pair: PromptEmbedsPair = prompt_pairs[prompt_index]
 
             # 1 ~ 49 からランダム
             timesteps_to = torch.randint(
@@ -172,79 +279,97 @@ def train(
                     print("bucketed resolution:", (height, width))
                 print("batch_size:", prompt_pair.batch_size)
 
-            latents = train_util.get_initial_latents(
-                noise_scheduler, prompt_pair.batch_size, height, width, 1
-            ).to(DEVICE_CUDA, dtype=weight_dtype)
+            start_timesteps = 0
+            latents = None
+            generator = None
+            # これまでに optimizer.step() した回数
+            optimizer_step = i // config.train.grad_accum_steps
+            started_at = optimizer_step
+            if trajectory_cache is not None:
+                # 決まった数の seed の中から初期ノイズを選んで、途中までのデノイズ結果を使い回す
+                seed = torch.randint(
+                    0, config.train.trajectory_noise_pool, (1,)
+                ).item()
+                generator = torch.Generator(DEVICE_CUDA).manual_seed(seed)
+                trajectory_key = (prompt_index, height, width, seed)
+                (
+                    start_timesteps,
+                    latents,
+                    started_at,
+                ) = trajectory_cache.get_nearest(
+                    trajectory_key, timesteps_to, optimizer_step
+                )
+
+            if latents is None:
+                latents = train_util.get_initial_latents(
+                    diffusion_scheduler,
+                    prompt_pair.batch_size,
+                    height,
+                    width,
+                    1,
+                    generator=generator,
+                    device=DEVICE_CUDA,
+                    dtype=weight_dtype,
+                ).to(memory_format=torch.channels_last)
 
             with network:
                 # ちょっとデノイズされれたものが返る
                 denoised_latents = train_util.diffusion(
-                    unet,
-                    noise_scheduler,
+                    diffusion_unet,
+                    diffusion_scheduler,
                     latents,  # 単純なノイズのlatentsを渡す
                     train_util.concat_embeddings(
                         prompt_pair.unconditional,
                         prompt_pair.target,
                         prompt_pair.batch_size,
                     ),
-                    start_timesteps=0,
+                    start_timesteps=start_timesteps,
                     total_timesteps=timesteps_to,
                     guidance_scale=3,
                 )
 
-            noise_scheduler.set_timesteps(1000)
+            if trajectory_cache is not None:
+                # 途中から再開した軌跡は、最初に始めたときの step を引き継ぐ
+                trajectory_cache[(trajectory_key, timesteps_to)] = (
+                    denoised_latents,
+                    started_at,
+                )
 
-            current_timestep = noise_scheduler.timesteps[
-                int(timesteps_to * 1000 / config.train.max_denoising_steps)
-            ]
+            current_timestep = timestep_lut[timesteps_to]
 
             # with network: の外では空のLoRAのみが有効になる
-            positive_latents = train_util.predict_noise(
-                unet,
-                noise_scheduler,
-                current_timestep,
-                denoised_latents,
-                train_util.concat_embeddings(
-                    prompt_pair.unconditional,
-                    prompt_pair.positive,
-                    prompt_pair.batch_size,
-                ),
-                guidance_scale=1,
-            ).to("cpu", dtype=torch.float32)
-            neutral_latents = train_util.predict_noise(
-                unet,
-                noise_scheduler,
-                current_timestep,
-                denoised_latents,
-                train_util.concat_embeddings(
-                    prompt_pair.unconditional,
-                    prompt_pair.neutral,
-                    prompt_pair.batch_size,
-                ),
-                guidance_scale=1,
-            ).to("cpu", dtype=torch.float32)
-            unconditional_latents = train_util.predict_noise(
-                unet,
-                noise_scheduler,
-                current_timestep,
-                denoised_latents,
-                train_util.concat_embeddings(
-                    prompt_pair.unconditional,
-                    prompt_pair.unconditional,
-                    prompt_pair.batch_size,
-                ),
-                guidance_scale=1,
-            ).to("cpu", dtype=torch.float32)
-
-            if config.logging.verbose:
-                print("positive_latents:", positive_latents[0, 0, :5, :5])
-                print("neutral_latents:", neutral_latents[0, 0, :5, :5])
-                print("unconditional_latents:", unconditional_latents[0, 0, :5, :5])
+            # positive, neutral, unconditional は入力の latents が同じなので一回の forward にまとめる
+            (
+                positive_latents,
+                neutral_latents,
+                unconditional_latents,
+            ) = (
+                train_util.predict_noise(
+                    frozen_unet,
+                    full_scheduler,
+                    current_timestep,
+                    denoised_latents.repeat(3, 1, 1, 1),
+                    train_util.concat_embeddings_multi(
+                        prompt_pair.unconditional,
+                        [
+                            prompt_pair.positive,
+                            prompt_pair.neutral,
+                            prompt_pair.unconditional,
+                        ],
+                        prompt_pair.batch_size,
+                    ),
+                    guidance_scale=1,
+                )
+                .to(dtype=torch.float32)
+                .chunk(3)
+            )
 
-        with network:
+        with network, torch.autocast(
+            "cuda", dtype=weight_dtype, enabled=use_autocast
+        ):
             target_latents = train_util.predict_noise(
                 unet,
-                noise_scheduler,
+                full_scheduler,
                 current_timestep,
                 denoised_latents,
                 train_util.concat_embeddings(
@@ -253,10 +378,7 @@ def train(
                     prompt_pair.batch_size,
                 ),
                 guidance_scale=1,
-            ).to("cpu", dtype=torch.float32)
-
-            if config.logging.verbose:
-                print("target_latents:", target_latents[0, 0, :5, :5])
+            ).to(dtype=torch.float32)
 
         positive_latents.requires_grad = False
         neutral_latents.requires_grad = False
@@ -269,16 +391,32 @@ def train(
             unconditional_latents=unconditional_latents,
         )
 
-        # 1000倍しないとずっと0.000...になってしまって見た目的に面白くない
-        pbar.set_description(f"Loss*1k: {loss.item()*1000:.4f}")
-        if config.logging.use_wandb:
-            wandb.log(
-                {"loss": loss, "iteration": i, "lr": lr_scheduler.get_last_lr()[0]}
-            )
+        lr = lr_scheduler.get_last_lr()[0]
+
+        # grad_accum_steps 回分の勾配を貯めてから更新する
+        # 最後の端数の window は実際に貯める回数で割る
+        window_start = i - i % config.train.grad_accum_steps
+        accum_steps = min(
+            config.train.grad_accum_steps, config.train.iterations - window_start
+        )
+        (loss / accum_steps).backward()
+        if (
+            (i + 1) % config.train.grad_accum_steps == 0
+            or i == config.train.iterations - 1
+        ):
+            optimizer.step()
+            lr_scheduler.step()
+            optimizer.zero_grad(set_to_none=True)
+
+        # .item() は GPU と同期するので、backward と optimizer の step を投げ終わってから、
+        # logging.per_steps ごとにだけ読む
+        if i % config.logging.per_steps == 0 or i == config.train.iterations - 1:
+            loss_value = loss.detach().float().item()
 
-        loss.backward()
-        optimizer.step()
-        lr_scheduler.step()
+            # 1000倍しないとずっと0.000...になってしまって見た目的に面白くない
+            pbar.set_description(f"Loss*1k: {loss_value*1000:.4f}")
+            if config.logging.use_wandb:
+                wandb.log({"loss": loss_value, "iteration": i, "lr": lr}, step=i)
 
         del (
             positive_latents,
@@ -287,7 +425,6 @@ def train(
             target_latents,
             latents,
         )
-        flush()
 
         if (
             i % config.save.per_steps == 0
@@ -5,11 +5,15 @@
 from typing import List, Optional
 import argparse
 import ast
+import copy
+import math
 from pathlib import Path
 import gc
 
 import torch
+import torch.nn.functional as F
 from tqdm import tqdm
+from diffusers.models.attention_processor import AttnProcessor2_0
 
 
 from lora import LoRANetwork, DEFAULT_TARGET_REPLACE, UNET_TARGET_REPLACE_MODULE_CONV
@@ -47,6 +51,11 @@ def train(
     }
     save_path = Path(config.save.path)
 
+    # fp32 の matmul/conv でも TF32 の Tensor Core を使う。入力の形はほぼ固定なので conv のアルゴリズムも最初に選ばせる
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cudnn.benchmark = True
+
     modules = DEFAULT_TARGET_REPLACE
     if config.network.type == "c3lier":
         modules += UNET_TARGET_REPLACE_MODULE_CONV
@@ -75,45 +84,7 @@ def train(
         text_encoder.requires_grad_(False)
         text_encoder.eval()
 
-    unet.to(DEVICE_CUDA, dtype=weight_dtype)
-    if config.other.use_xformers:
-        unet.enable_xformers_memory_efficient_attention()
-    unet.requires_grad_(False)
-    unet.eval()
-
-    network = LoRANetwork(
-        unet,
-        rank=config.network.rank,
-        multiplier=1.0,
-        alpha=config.network.alpha,
-        train_method=config.network.training_method,
-    ).to(DEVICE_CUDA, dtype=weight_dtype)
-
-    optimizer_module = train_util.get_optimizer(config.train.optimizer)
-    #optimizer_args
-    optimizer_kwargs = {}
-    if config.train.optimizer_args is not None and len(config.train.optimizer_args) > 0:
-        for arg in config.train.optimizer_args.split(" "):
-            key, value = arg.split("=")
-            value = ast.literal_eval(value)
-            optimizer_kwargs[key] = value
-            
-    optimizer = optimizer_module(network.prepare_optimizer_params(), lr=config.train.lr, **optimizer_kwargs)
-    lr_scheduler = train_util.get_lr_scheduler(
-        config.train.lr_scheduler,
-        optimizer,
-        max_iterations=config.train.iterations,
-        lr_min=config.train.lr / 100,
-    )
-    criteria = torch.nn.MSELoss()
-
-    print("Prompts")
-    for settings in prompts:
-        print(settings)
-
-    # debug
-    debug_util.check_requires_grad(network)
-    debug_util.check_training_mode(network)
+    criteria = F.mse_loss
 
     cache = PromptEmbedsCache()
     prompt_pairs: list[PromptEmbedsPair] = []
@@ -148,22 +119,122 @@ def train(
                 )
             )
 
-    for tokenizer, text_encoder in zip(tokenizers, text_encoders):
-        del tokenizer, text_encoder
+    # unet を載せる前に text encoder を GPU から降ろしておく
+    for text_encoder in text_encoders:
+        text_encoder.to("cpu")
+    del tokenizers, text_encoders, text_encoder
 
     flush()
 
+    unet.to(DEVICE_CUDA, dtype=weight_dtype)
+    # conv は NHWC の方が cuDNN の速いカーネルが使える
+    unet.to(memory_format=torch.channels_last)
+    if config.other.use_xformers:
+        unet.enable_xformers_memory_efficient_attention()
+    else:
+        # PyTorch 2 の scaled_dot_product_attention (FlashAttention など) を使う
+        unet.set_attn_processor(AttnProcessor2_0())
+    unet.requires_grad_(False)
+    unet.eval()
+
+    network = LoRANetwork(
+        unet,
+        rank=config.network.rank,
+        multiplier=1.0,
+        alpha=config.network.alpha,
+        train_method=config.network.training_method,
+    ).to(
+        DEVICE_CUDA,
+        dtype=torch.float32,
+        memory_format=torch.channels_last,
+    )
+
+    # 凍結した unet は weight_dtype のまま、学習する LoRA の重みは fp32 で持っておいて autocast で計算する
+    # (LoRA の重みまで低精度にすると小さな更新が丸められて不安定になる)
+    use_autocast = weight_dtype != torch.float32
+
+    if config.other.use_torch_compile:
+        # 最初の数 iteration は compile 待ちで遅くなる
+        unet = train_util.compile_unet(unet)
+
+    # diffusion() は LoRA を有効にした状態でしか呼ばないので、そこだけ CUDA Graph で回す
+    diffusion_unet = unet
+    if config.other.use_cuda_graph and not config.other.use_torch_compile:
+        diffusion_unet = train_util.CUDAGraphUNet(unet)
+
+    optimizer_module = train_util.get_optimizer(config.train.optimizer)
+    #optimizer_args
+    optimizer_kwargs = {}
+    if config.train.optimizer_args is not None and len(config.train.optimizer_args) > 0:
+        for arg in config.train.optimizer_args.split(" "):
+            key, value = arg.split("=")
+            value = ast.literal_eval(value)
+            optimizer_kwargs[key] = value
+
+    if (
+        optimizer_module in (torch.optim.Adam, torch.optim.AdamW)
+        and "foreach" not in optimizer_kwargs
+    ):
+        # LoRA は小さいパラメータが大量にあるので、パラメータごとではなくまとめて一つのカーネルで更新する
+        # (fused と foreach は同時に指定できないので、foreach が指定されていたらそちらに任せる)
+        optimizer_kwargs.setdefault("fused", True)
+
+    optimizer = optimizer_module(network.prepare_optimizer_params(), lr=config.train.lr, **optimizer_kwargs)
+    lr_scheduler = train_util.get_lr_scheduler(
+        config.train.lr_scheduler,
+        optimizer,
+        # lr_scheduler は optimizer を更新したときだけ進める
+        max_iterations=math.ceil(
+            config.train.iterations / config.train.grad_accum_steps
+        ),
+        lr_min=config.train.lr / 100,
+    )
+
+    print("Prompts")
+    for settings in prompts:
+        print(settings)
+
+    # debug
+    if config.logging.verbose:
+        debug_util.check_requires_grad(network)
+        debug_util.check_training_mode(network)
+
+    # set_timesteps は毎回呼ぶとテーブルを作り直すので、ループの外で一度だけ
+    noise_scheduler.set_timesteps(
+        config.train.max_denoising_steps, device=DEVICE_CUDA
+    )
+    full_noise_scheduler = copy.deepcopy(noise_scheduler)
+    full_noise_scheduler.set_timesteps(1000)
+    # timesteps_to から 1000 step 中のタイムステップを引くための表
+    # (scheduler の timesteps と同じ CPU に置いておく。GPU に置くと scheduler 内の比較でデバイスが合わない)
+    timestep_lut = full_noise_scheduler.timesteps[
+        torch.arange(config.train.max_denoising_steps)
+        * 1000
+        // config.train.max_denoising_steps
+    ]
+
+    if config.train.trajectory_cache_size > 0:
+        print(
+            "Warning: trajectory_cache_size is only supported by train_lora.py (SD v1/v2) and is ignored for SDXL."
+        )
+    if config.other.use_aot_compile:
+        print(
+            "Warning: use_aot_compile is only supported by train_lora.py (SD v1/v2) and is ignored for SDXL."
+        )
+
     pbar = tqdm(range(config.train.iterations))
 
     loss = None
 
     for i in pbar:
-        with torch.no_grad():
-            noise_scheduler.set_timesteps(
-                config.train.max_denoising_steps, device=DEVICE_CUDA
-            )
-
-            optimizer.zero_grad()
+        # 勾配の要らない推論は inference_mode で autograd の記録を完全に切る
+        # (text embeddings は LoRA の backward で保存されるので、そちらは no_grad のまま作っている)
+        with torch.inference_mode(), torch.autocast(
+            "cuda", dtype=weight_dtype, enabled=use_autocast
+        ):
+            # step() で内部状態が変わる scheduler もあるので、毎回設定済みのものからコピーする
+            diffusion_scheduler = copy.deepcopy(noise_scheduler)
+            full_scheduler = copy.deepcopy(full_noise_scheduler)
 
             prompt_pair: PromptEmbedsPair = prompt_pairs[
                 torch.randint(0, len(prompt_pairs), (1,)).item()
@@ -190,8 +261,14 @@ def train(
                 print("dynamic_crops:", prompt_pair.dynamic_crops)
 
             latents = train_util.get_initial_latents(
-                noise_scheduler, prompt_pair.batch_size, height, width, 1
-            ).to(DEVICE_CUDA, dtype=weight_dtype)
+                diffusion_scheduler,
+                prompt_pair.batch_size,
+                height,
+                width,
+                1,
+                device=DEVICE_CUDA,
+                dtype=weight_dtype,
+            ).to(memory_format=torch.channels_last)
 
             add_time_ids = train_util.get_add_time_ids(
                 height,
@@ -203,8 +280,8 @@ def train(
             with network:
                 # ちょっとデノイズされれたものが返る
                 denoised_latents = train_util.diffusion_xl(
-                    unet,
-                    noise_scheduler,
+                    diffusion_unet,
+                    diffusion_scheduler,
                     latents,  # 単純なノイズのlatentsを渡す
                     text_embeddings=train_util.concat_embeddings(
                         prompt_pair.unconditional.text_embeds,
@@ -224,83 +301,53 @@ def train(
                     guidance_scale=3,
                 )
 
-            noise_scheduler.set_timesteps(1000)
-
-            current_timestep = noise_scheduler.timesteps[
-                int(timesteps_to * 1000 / config.train.max_denoising_steps)
-            ]
+            current_timestep = timestep_lut[timesteps_to]
 
             # with network: の外では空のLoRAのみが有効になる
-            positive_latents = train_util.predict_noise_xl(
-                unet,
-                noise_scheduler,
-                current_timestep,
-                denoised_latents,
-                text_embeddings=train_util.concat_embeddings(
-                    prompt_pair.unconditional.text_embeds,
-                    prompt_pair.positive.text_embeds,
-                    prompt_pair.batch_size,
-                ),
-                add_text_embeddings=train_util.concat_embeddings(
-                    prompt_pair.unconditional.pooled_embeds,
-                    prompt_pair.positive.pooled_embeds,
-                    prompt_pair.batch_size,
-                ),
-                add_time_ids=train_util.concat_embeddings(
-                    add_time_ids, add_time_ids, prompt_pair.batch_size
-                ),
-                guidance_scale=1,
-            ).to("cpu", dtype=torch.float32)
-            neutral_latents = train_util.predict_noise_xl(
-                unet,
-                noise_scheduler,
-                current_timestep,
-                denoised_latents,
-                text_embeddings=train_util.concat_embeddings(
-                    prompt_pair.unconditional.text_embeds,
-                    prompt_pair.neutral.text_embeds,
-                    prompt_pair.batch_size,
-                ),
-                add_text_embeddings=train_util.concat_embeddings(
-                    prompt_pair.unconditional.pooled_embeds,
-                    prompt_pair.neutral.pooled_embeds,
-                    prompt_pair.batch_size,
-                ),
-                add_time_ids=train_util.concat_embeddings(
-                    add_time_ids, add_time_ids, prompt_pair.batch_size
-                ),
-                guidance_scale=1,
-            ).to("cpu", dtype=torch.float32)
-            unconditional_latents = train_util.predict_noise_xl(
-                unet,
-                noise_scheduler,
-                current_timestep,
-                denoised_latents,
-                text_embeddings=train_util.concat_embeddings(
-                    prompt_pair.unconditional.text_embeds,
-                    prompt_pair.unconditional.text_embeds,
-                    prompt_pair.batch_size,
-                ),
-                add_text_embeddings=train_util.concat_embeddings(
-                    prompt_pair.unconditional.pooled_embeds,
-                    prompt_pair.unconditional.pooled_embeds,
-                    prompt_pair.batch_size,
-                ),
-                add_time_ids=train_util.concat_embeddings(
-                    add_time_ids, add_time_ids, prompt_pair.batch_size
-                ),
-                guidance_scale=1,
-            ).to("cpu", dtype=torch.float32)
-
-            if config.logging.verbose:
-                print("positive_latents:", positive_latents[0, 0, :5, :5])
-                print("neutral_latents:", neutral_latents[0, 0, :5, :5])
-                print("unconditional_latents:", unconditional_latents[0, 0, :5, :5])
+            # positive, neutral, unconditional は入力の latents が同じなので一回の forward にまとめる
+            (
+                positive_latents,
+                neutral_latents,
+                unconditional_latents,
+            ) = (
+                train_util.predict_noise_xl(
+                    unet,
+                    full_scheduler,
+                    current_timestep,
+                    denoised_latents.repeat(3, 1, 1, 1),
+                    text_embeddings=train_util.concat_embeddings_multi(
+                        prompt_pair.unconditional.text_embeds,
+                        [
+                            prompt_pair.positive.text_embeds,
+                            prompt_pair.neutral.text_embeds,
+                            prompt_pair.unconditional.text_embeds,
+                        ],
+                        prompt_pair.batch_size,
+                    ),
+                    add_text_embeddings=train_util.concat_embeddings_multi(
+                        prompt_pair.unconditional.pooled_embeds,
+                        [
+                            prompt_pair.positive.pooled_embeds,
+                            prompt_pair.neutral.pooled_embeds,
+                            prompt_pair.unconditional.pooled_embeds,
+                        ],
+                        prompt_pair.batch_size,
+                    ),
+                    add_time_ids=train_util.concat_embeddings_multi(
+                        add_time_ids, [add_time_ids] * 3, prompt_pair.batch_size
+                    ),
+                    guidance_scale=1,
+                )
+                .to(dtype=torch.float32)
+                .chunk(3)
+            )
 
-        with network:
+        with network, torch.autocast(
+            "cuda", dtype=weight_dtype, enabled=use_autocast
+        ):
             target_latents = train_util.predict_noise_xl(
                 unet,
-                noise_scheduler,
+                full_scheduler,
                 current_timestep,
                 denoised_latents,
                 text_embeddings=train_util.concat_embeddings(
@@ -317,10 +364,7 @@ def train(
                     add_time_ids, add_time_ids, prompt_pair.batch_size
                 ),
                 guidance_scale=1,
-            ).to("cpu", dtype=torch.float32)
-
-            if config.logging.verbose:
-                print("target_latents:", target_latents[0, 0, :5, :5])
+            ).to(dtype=torch.float32)
 
         positive_latents.requires_grad = False
         neutral_latents.requires_grad = False
@@ -333,16 +377,32 @@ def train(
             unconditional_latents=unconditional_latents,
         )
 
-        # 1000倍しないとずっと0.000...になってしまって見た目的に面白くない
-        pbar.set_description(f"Loss*1k: {loss.item()*1000:.4f}")
-        if config.logging.use_wandb:
-            wandb.log(
-                {"loss": loss, "iteration": i, "lr": lr_scheduler.get_last_lr()[0]}
-            )
+        lr = lr_scheduler.get_last_lr()[0]
+
+        # grad_accum_steps 回分の勾配を貯めてから更新する
+        # 最後の端数の window は実際に貯める回数で割る
+        window_start = i - i % config.train.grad_accum_steps
+        accum_steps = min(
+            config.train.grad_accum_steps, config.train.iterations - window_start
+        )
+        (loss / accum_steps).backward()
+        if (
+            (i + 1) % config.train.grad_accum_steps == 0
+            or i == config.train.iterations - 1
+        ):
+            optimizer.step()
+            lr_scheduler.step()
+            optimizer.zero_grad(set_to_none=True)
+
+        # .item() は GPU と同期するので、backward と optimizer の step を投げ終わってから、
+        # logging.per_steps ごとにだけ読む
+        if i % config.logging.per_steps == 0 or i == config.train.iterations - 1:
+            loss_value = loss.detach().float().item()
 
-        loss.backward()
-        optimizer.step()
-        lr_scheduler.step()
+            # 1000倍しないとずっと0.000...になってしまって見た目的に面白くない
+            pbar.set_description(f"Loss*1k: {loss_value*1000:.4f}")
+            if config.logging.use_wandb:
+                wandb.log({"loss": loss_value, "iteration": i, "lr": lr}, step=i)
 
         del (
             positive_latents,
@@ -351,7 +411,6 @@ def train(
             target_latents,
             latents,
         )
-        flush()
 
         if (
             i % config.save.per_steps == 0
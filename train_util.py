@@ -1,4 +1,8 @@
+import os
+import hashlib
 from typing import Optional, Union
+from collections import OrderedDict
+from types import SimpleNamespace
 
 import torch
 
@@ -16,10 +20,18 @@ UNET_ATTENTION_TIME_EMBED_DIM = 256  # XL
 TEXT_ENCODER_2_PROJECTION_DIM = 1280
 UNET_PROJECTION_CLASS_EMBEDDING_INPUT_DIM = 2816
 
+AOT_PACKAGE_CACHE_DIR = "./.aoti_cache"  # AOT compile した UNet の package を置く場所
+
 
 def get_random_noise(
-    batch_size: int, height: int, width: int, generator: torch.Generator = None
+    batch_size: int,
+    height: int,
+    width: int,
+    generator: torch.Generator = None,
+    device: Union[str, torch.device] = "cpu",
+    dtype: Optional[torch.dtype] = None,
 ) -> torch.Tensor:
+    # device に直接生成する (generator も同じ device のものを渡すこと)
     return torch.randn(
         (
             batch_size,
@@ -28,7 +40,8 @@ def get_random_noise(
             width // VAE_SCALE_FACTOR,
         ),
         generator=generator,
-        device="cpu",
+        device=device,
+        dtype=dtype,
     )
 
 
@@ -47,10 +60,12 @@ def get_initial_latents(
     width: int,
     n_prompts: int,
     generator=None,
+    device: Union[str, torch.device] = "cpu",
+    dtype: Optional[torch.dtype] = None,
 ) -> torch.Tensor:
-    noise = get_random_noise(n_imgs, height, width, generator=generator).repeat(
-        n_prompts, 1, 1, 1
-    )
+    noise = get_random_noise(
+        n_imgs, height, width, generator=generator, device=device, dtype=dtype
+    ).repeat(n_prompts, 1, 1, 1)
 
     latents = noise * scheduler.init_noise_sigma
 
@@ -138,6 +153,18 @@ def concat_embeddings(
     return torch.cat([unconditional, conditional]).repeat_interleave(n_imgs, dim=0)
 
 
+# 複数の cond を一回の forward でまとめて推論するときに使う
+# concat_embeddings と同じく uncond -> cond の順に並べるので、predict_noise の chunk(2) でそのまま分けられる
+def concat_embeddings_multi(
+    unconditional: torch.FloatTensor,
+    conditionals: list[torch.FloatTensor],
+    n_imgs: int,
+):
+    return torch.cat(
+        [unconditional] * len(conditionals) + conditionals
+    ).repeat_interleave(n_imgs, dim=0)
+
+
 # ref: https://github.com/huggingface/diffusers/blob/0bab447670f47c28df60fbd2f6a0f833f75a16f5/src/diffusers/pipelines/stable_diffusion/pipeline_stable_diffusion.py#L721
 def predict_noise(
     unet: UNet2DConditionModel,
@@ -193,6 +220,56 @@ def diffusion(
     return latents
 
 
+class TrajectoryCache:  # diffusion の途中結果を使い回したいので
+    """
+    LRU cache of partially denoised latents keyed by (trajectory key, step).
+    The trajectory key identifies the prompt, resolution and initial noise seed.
+
+    Each entry remembers the optimizer step at which its trajectory was started, so
+    latents denoised by a LoRA more than max_age optimizer steps old are treated as misses.
+    """
+
+    def __init__(self, max_size: int, max_age: int) -> None:
+        self.max_size = max_size
+        self.max_age = max_age
+        self.latents: OrderedDict[
+            tuple, tuple[torch.FloatTensor, int]
+        ] = OrderedDict()
+
+    def __setitem__(
+        self, __name: tuple, __value: tuple[torch.FloatTensor, int]
+    ) -> None:
+        # __value は (latents, その軌跡を始めたときの optimizer step)
+        self.latents[__name] = __value
+        self.latents.move_to_end(__name)
+
+        if len(self.latents) > self.max_size:
+            self.latents.popitem(last=False)
+
+    def get_nearest(
+        self, key: tuple, total_timesteps: int, optimizer_step: int
+    ) -> tuple[int, Optional[torch.FloatTensor], int]:
+        """
+        Returns (step, latents, started_at) for the furthest fresh cached step not after
+        total_timesteps, or (0, None, optimizer_step) if there is none.
+        """
+
+        for step in range(total_timesteps, 0, -1):
+            if (key, step) not in self.latents:
+                continue
+
+            latents, started_at = self.latents[(key, step)]
+            if optimizer_step - started_at > self.max_age:
+                # 古い LoRA で作った軌跡なので捨てる
+                del self.latents[(key, step)]
+                continue
+
+            self.latents.move_to_end((key, step))
+            return step, latents, started_at
+
+        return 0, None, optimizer_step
+
+
 def rescale_noise_cfg(
     noise_cfg: torch.FloatTensor, noise_pred_text, guidance_rescale=0.0
 ):
@@ -330,6 +407,232 @@ def get_add_time_ids(
     return add_time_ids
 
 
+class CUDAGraphUNet:  # diffusion() の中で同じ形の unet を何十回も呼ぶので
+    """
+    Captures the UNet forward into a CUDA graph for the first input shape it sees and
+    replays it afterwards. Other shapes, and calls outside inference_mode, run eagerly.
+
+    The LoRA multiplier is baked into the graph at capture time, so only use this for
+    calls that always run with the same network state (diffusion() under `with network:`).
+    LoRA weights are read from their own buffers, so optimizer updates are picked up.
+    """
+
+    def __init__(self, unet: UNet2DConditionModel, warmup_steps: int = 3) -> None:
+        self.unet = unet
+        self.warmup_steps = warmup_steps
+
+        self.graph: Optional[torch.cuda.CUDAGraph] = None
+        self.graph_key: Optional[tuple] = None
+        self.static_inputs: list[torch.Tensor] = []
+        self.static_output: Optional[torch.FloatTensor] = None
+
+    def _forward(
+        self, inputs: list[torch.Tensor], added_cond_keys: list[str]
+    ) -> torch.FloatTensor:
+        sample, timestep, encoder_hidden_states, *added_cond = inputs
+
+        return self.unet(
+            sample,
+            timestep,
+            encoder_hidden_states=encoder_hidden_states,
+            added_cond_kwargs=dict(zip(added_cond_keys, added_cond))
+            if added_cond_keys
+            else None,
+        ).sample
+
+    def _capture(self, inputs: list[torch.Tensor], added_cond_keys: list[str]):
+        self.static_inputs = [t.clone() for t in inputs]
+
+        # autocast のキャッシュはグラフの外のメモリになってしまうので無効にする
+        autocast_kwargs = dict(
+            device_type="cuda",
+            dtype=torch.get_autocast_dtype("cuda"),
+            enabled=torch.is_autocast_enabled("cuda"),
+            cache_enabled=False,
+        )
+
+        # ref: https://pytorch.org/docs/stable/notes/cuda.html#cuda-graphs
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream), torch.autocast(**autocast_kwargs):
+            for _ in range(self.warmup_steps):
+                self._forward(self.static_inputs, added_cond_keys)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph), torch.autocast(**autocast_kwargs):
+            self.static_output = self._forward(self.static_inputs, added_cond_keys)
+
+    def __call__(
+        self,
+        sample: torch.FloatTensor,
+        timestep: Union[torch.Tensor, int],
+        encoder_hidden_states: torch.FloatTensor,
+        added_cond_kwargs: Optional[dict[str, torch.Tensor]] = None,
+    ) -> SimpleNamespace:
+        added_cond_keys = sorted(added_cond_kwargs or {})
+        inputs = [
+            sample,
+            torch.as_tensor(timestep, device=sample.device),
+            encoder_hidden_states,
+        ] + [added_cond_kwargs[key] for key in added_cond_keys]
+
+        if not torch.is_inference_mode_enabled():
+            return SimpleNamespace(sample=self._forward(inputs, added_cond_keys))
+
+        key = (
+            tuple((t.shape, t.dtype, t.device) for t in inputs),
+            tuple(added_cond_keys),
+            torch.is_autocast_enabled("cuda"),
+            torch.get_autocast_dtype("cuda"),
+        )
+        if self.graph is None:
+            self._capture(inputs, added_cond_keys)
+            self.graph_key = key
+
+        if key != self.graph_key:
+            # 解像度などが変わったら eager で計算する
+            return SimpleNamespace(sample=self._forward(inputs, added_cond_keys))
+
+        for static_input, new_input in zip(self.static_inputs, inputs):
+            static_input.copy_(new_input)
+        self.graph.replay()
+
+        # 次の replay で上書きされるので、呼び出し側ですぐに使い切ること
+        return SimpleNamespace(sample=self.static_output)
+
+
+def compile_unet(unet: UNet2DConditionModel) -> UNet2DConditionModel:
+    # LoRA の forward 差し替えは compile 前に済ませておくこと (compile 後だと module 名に _orig_mod が付く)
+    import torch._dynamo
+
+    # torch.compile は最初に呼ばれたときに compile するので、ここで例外を捕まえても意味がない。
+    # Dynamo/Inductor のエラーは suppress_errors で eager にフォールバックさせる
+    # (プロセス全体の設定なので、他の compile されたコードのエラーも握りつぶされる点に注意)
+    torch._dynamo.config.suppress_errors = True
+
+    return torch.compile(unet, mode="reduce-overhead", fullgraph=False, dynamic=False)
+
+
+class AOTCompiledUNet:
+    """
+    UNet exported with torch.export and compiled ahead of time with AOTInductor for one
+    fixed input shape. Inputs with another shape, dtype or device run through the eager UNet.
+
+    Export the UNet before LoRANetwork patches it: the result is the bare UNet, i.e. what
+    the LoRA-disabled predictions compute. The weights are not packaged; the live UNet
+    parameters are handed to the compiled model, so no second copy is kept on the device.
+    The package is cached on disk by model, input layout and torch version, and reused.
+    """
+
+    def __init__(
+        self,
+        unet: UNet2DConditionModel,
+        sample: torch.FloatTensor,
+        timestep: torch.Tensor,
+        encoder_hidden_states: torch.FloatTensor,
+        model_name_or_path: str,
+        cache_dir: str = AOT_PACKAGE_CACHE_DIR,
+    ) -> None:
+        self.unet = unet
+        self.compiled_calls = 0
+        self.input_key = self._key(sample, timestep, encoder_hidden_states)
+
+        package_path = self._package_path(unet, model_name_or_path, cache_dir)
+        if os.path.exists(package_path):
+            print(f"Loading AOT compiled UNet from {package_path}")
+        else:
+            exported = torch.export.export(
+                unet,
+                args=(sample, timestep),
+                kwargs={
+                    "encoder_hidden_states": encoder_hidden_states,
+                    "return_dict": False,
+                },
+            )
+            os.makedirs(cache_dir, exist_ok=True)
+            torch._inductor.aoti_compile_and_package(
+                exported,
+                package_path=package_path,
+                # 重みは package に入れず、load_constants で UNet のものを共有する
+                inductor_configs={"aot_inductor.package_constants_in_so": False},
+            )
+        self.compiled = torch._inductor.aoti_load_package(package_path)
+
+        constants = dict(unet.named_parameters())
+        constants.update(unet.named_buffers())
+        self.compiled.load_constants(
+            constants, check_full_update=True, user_managed=True
+        )
+
+    def _package_path(
+        self, unet: UNet2DConditionModel, model_name_or_path: str, cache_dir: str
+    ) -> str:
+        # 重みは入っていないので、モデルの構造と入力のレイアウトが同じなら使い回せる
+        attn_processors = sorted(
+            {type(p).__name__ for p in unet.attn_processors.values()}
+        )
+        key = repr(
+            (
+                model_name_or_path,
+                self.input_key,
+                attn_processors,
+                torch.__version__,
+            )
+        )
+        digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+        return os.path.join(cache_dir, f"unet-{digest}.pt2")
+
+    @staticmethod
+    def _key(*inputs: torch.Tensor) -> tuple:
+        return tuple((t.shape, t.stride(), t.dtype, t.device) for t in inputs)
+
+    def __call__(
+        self,
+        sample: torch.FloatTensor,
+        timestep: torch.Tensor,
+        encoder_hidden_states: torch.FloatTensor,
+    ) -> SimpleNamespace:
+        if (
+            not isinstance(timestep, torch.Tensor)
+            or self._key(sample, timestep, encoder_hidden_states) != self.input_key
+        ):
+            return self.unet(
+                sample, timestep, encoder_hidden_states=encoder_hidden_states
+            )
+
+        (noise_pred,) = self.compiled(
+            sample,
+            timestep,
+            encoder_hidden_states=encoder_hidden_states,
+            return_dict=False,
+        )
+
+        if self.compiled_calls == 0:
+            print("Using AOT compiled UNet.")
+        self.compiled_calls += 1
+
+        return SimpleNamespace(sample=noise_pred)
+
+
+def aot_compile_unet(
+    unet: UNet2DConditionModel,
+    sample: torch.FloatTensor,
+    timestep: torch.Tensor,
+    encoder_hidden_states: torch.FloatTensor,
+    model_name_or_path: str,
+) -> Optional[AOTCompiledUNet]:
+    # 失敗したら None を返すので、呼び出し側で元の unet を使うこと
+    try:
+        with torch.no_grad():
+            return AOTCompiledUNet(
+                unet, sample, timestep, encoder_hidden_states, model_name_or_path
+            )
+    except Exception as e:
+        print(f"AOT compile is not available, falling back to the UNet: {e}")
+        return None
+
+
 def get_optimizer(name: str):
     name = name.lower()
 